@@ -3,49 +3,287 @@ import { Server } from "@modelcontextprotocol/sdk/server/index.js";
 import { StdioServerTransport } from "@modelcontextprotocol/sdk/server/stdio.js";
 import { CallToolRequestSchema, ListToolsRequestSchema, } from "@modelcontextprotocol/sdk/types.js";
 import nodeFetch from "node-fetch";
+import { mkdir, readFile, rename, writeFile } from "node:fs/promises";
+import { homedir } from "node:os";
+import { join } from "node:path";
+import { deserialize, serialize } from "node:v8";
 // Use node-fetch as fallback for older Node versions
 const fetchImpl = globalThis.fetch || nodeFetch;
 const BERLIN_SERVICES_URL = "https://service.berlin.de/export/dienstleistungen/json/";
+// Upper bound for a single upstream request, so a stalled refresh can't hang every tool call
+const FETCH_TIMEOUT_MS = 30 * 1000;
+// How long a fetched dataset is served before it is refreshed from upstream
+const CACHE_TTL_MS = 60 * 60 * 1000;
+// How long a stale dataset is served after a failed refresh before trying again
+const REFRESH_RETRY_MS = 60 * 1000;
+// Length of the substrings used to narrow down search candidates
+const TRIGRAM_LENGTH = 3;
+// Bump whenever ServicesIndex changes shape, so older files on disk are ignored
+const INDEX_FORMAT_VERSION = 1;
+const INDEX_CACHE_DIR = join(userCacheDir(), "berlin-services-mcp");
+const INDEX_CACHE_FILE = join(INDEX_CACHE_DIR, "index.v8");
 // Cache for the services data
-let servicesCache = null;
+let cacheEntry = null;
+// Index saved by a previous run: undefined until read from disk, then kept as
+// the revalidation base and stale fallback until a refresh succeeds
+let persistedEntry = undefined;
+// In-flight refresh, shared so concurrent callers trigger a single download
+let pendingFetch = null;
+// Bumped by invalidateCache() so refreshes started before it don't store their result
+let cacheGeneration = 0;
+// Maximum number of rendered service details kept in memory per index
+const DETAILS_CACHE_SIZE = 512;
+// Rendered service details by service ID, least recently used first. Tied to the
+// index they were rendered from, so they are dropped together with it.
+const detailsCache = new WeakMap();
 async function fetchServicesData() {
-    if (servicesCache !== null) {
-        return servicesCache;
+    if (cacheEntry !== null && performance.now() - cacheEntry.fetchedAt < CACHE_TTL_MS) {
+        return cacheEntry.index;
     }
+    if (pendingFetch === null) {
+        const refresh = refreshServicesData().finally(() => {
+            // An invalidation may already have replaced this refresh with a newer one
+            if (pendingFetch === refresh) {
+                pendingFetch = null;
+            }
+        });
+        pendingFetch = refresh;
+    }
+    return pendingFetch;
+}
+async function refreshServicesData() {
+    const generation = cacheGeneration;
+    if (persistedEntry === undefined) {
+        const loaded = await loadPersistedIndex();
+        if (generation === cacheGeneration) {
+            persistedEntry = loaded;
+        }
+    }
+    const previous = cacheEntry ?? persistedEntry ?? null;
     try {
-        const response = await fetchImpl(BERLIN_SERVICES_URL);
+        const headers = {};
+        if (previous?.etag) {
+            headers["If-None-Match"] = previous.etag;
+        }
+        if (previous?.lastModified) {
+            headers["If-Modified-Since"] = previous.lastModified;
+        }
+        const response = await fetchImpl(BERLIN_SERVICES_URL, {
+            headers,
+            signal: AbortSignal.timeout(FETCH_TIMEOUT_MS),
+        });
+        if (response.status === 304 && previous !== null) {
+            if (generation !== cacheGeneration) {
+                return previous.index;
+            }
+            // Dataset unchanged upstream, keep the existing index
+            persistedEntry = null;
+            cacheEntry = {
+                index: previous.index,
+                etag: previous.etag,
+                lastModified: previous.lastModified,
+                fetchedAt: performance.now(),
+            };
+            return previous.index;
+        }
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         const data = await response.json();
-        servicesCache = data;
-        return data;
+        let index;
+        if (previous !== null && data.hash && data.hash === previous.index.data.hash) {
+            // Same dataset served with new validators, the existing index still applies
+            index = previous.index;
+        }
+        else {
+            compactServicesData(data);
+            index = buildServicesIndex(data);
+        }
+        if (generation !== cacheGeneration) {
+            return index;
+        }
+        const stored = {
+            index,
+            etag: response.headers.get("etag"),
+            lastModified: response.headers.get("last-modified"),
+        };
+        persistedEntry = null;
+        cacheEntry = { ...stored, fetchedAt: performance.now() };
+        // Serializing the index is expensive, so only rewrite the file when it would change
+        if (previous === null ||
+            index !== previous.index ||
+            stored.etag !== previous.etag ||
+            stored.lastModified !== previous.lastModified) {
+            void persistIndex(stored);
+        }
+        return index;
     }
     catch (error) {
-        throw new Error(`Failed to fetch Berlin services data: ${error}`);
+        if (previous === null || generation !== cacheGeneration) {
+            throw new Error(`Failed to fetch Berlin services data: ${error}`);
+        }
+        // Keep answering from the last good dataset and retry after a short delay
+        console.error(`Failed to refresh Berlin services data, serving cached copy created ${previous.index.data.created}:`, error);
+        cacheEntry = {
+            index: previous.index,
+            etag: previous.etag,
+            lastModified: previous.lastModified,
+            fetchedAt: performance.now() - CACHE_TTL_MS + REFRESH_RETRY_MS,
+        };
+        return previous.index;
+    }
+}
+// Drop the cached dataset so the next request fetches a fresh copy
+function invalidateCache() {
+    cacheGeneration++;
+    cacheEntry = null;
+    pendingFetch = null;
+    persistedEntry = null;
+}
+function userCacheDir() {
+    if (process.platform === "win32") {
+        return process.env.LOCALAPPDATA || join(homedir(), "AppData", "Local");
+    }
+    if (process.platform === "darwin") {
+        return join(homedir(), "Library", "Caches");
+    }
+    return process.env.XDG_CACHE_HOME || join(homedir(), ".cache");
+}
+// Index saved by a previous run, used to revalidate instead of downloading on startup
+async function loadPersistedIndex() {
+    try {
+        const persisted = deserialize(await readFile(INDEX_CACHE_FILE));
+        if (persisted?.version !== INDEX_FORMAT_VERSION) {
+            return null;
+        }
+        return { index: persisted.index, etag: persisted.etag, lastModified: persisted.lastModified };
+    }
+    catch {
+        // Missing or unreadable file, fall back to a full download
+        return null;
     }
 }
-function searchServices(data, query) {
+async function persistIndex(stored) {
+    const persisted = { version: INDEX_FORMAT_VERSION, ...stored };
+    const tempFile = `${INDEX_CACHE_FILE}.${process.pid}.tmp`;
+    try {
+        await mkdir(INDEX_CACHE_DIR, { recursive: true });
+        await writeFile(tempFile, serialize(persisted));
+        // Rename so a concurrent reader never sees a partially written file
+        await rename(tempFile, INDEX_CACHE_FILE);
+    }
+    catch (error) {
+        console.error("Failed to persist services index:", error);
+    }
+}
+// Remove per-location details, a bulky part of the payload that is
+// not used by any tool, so it does not stay resident for the cache lifetime
+function compactServicesData(data) {
+    for (const service of data.data) {
+        delete service.locations;
+    }
+}
+function buildServicesIndex(data) {
+    const byId = new Map();
+    const namesLower = [];
+    const descriptionsLower = [];
+    const summaries = [];
+    const trigrams = new Map();
+    data.data.forEach((service, position) => {
+        // Keep the first occurrence, matching the previous linear lookup
+        const id = String(service.id);
+        if (!byId.has(id)) {
+            byId.set(id, service);
+        }
+        const nameLower = (service.name || "").toLowerCase();
+        const descriptionLower = (service.description || "").toLowerCase();
+        namesLower.push(nameLower);
+        descriptionsLower.push(descriptionLower);
+        const desc = service.description || "";
+        summaries.push({
+            id: service.id,
+            name: service.name,
+            description: desc.length > 200 ? desc.substring(0, 200) + "..." : desc,
+            url: service.meta?.url || "",
+            fees: service.fees || "",
+        });
+        for (const lower of [nameLower, descriptionLower]) {
+            for (let i = 0; i + TRIGRAM_LENGTH <= lower.length; i++) {
+                const trigram = lower.substring(i, i + TRIGRAM_LENGTH);
+                let postings = trigrams.get(trigram);
+                if (postings === undefined) {
+                    postings = [];
+                    trigrams.set(trigram, postings);
+                }
+                // Services are visited in order, so a duplicate can only be the last entry
+                if (postings[postings.length - 1] !== position) {
+                    postings.push(position);
+                }
+            }
+        }
+    });
+    return { data, byId, namesLower, descriptionsLower, summaries, trigrams };
+}
+function intersectSorted(a, b) {
+    const result = [];
+    let i = 0;
+    let j = 0;
+    while (i < a.length && j < b.length) {
+        if (a[i] === b[j]) {
+            result.push(a[i]);
+            i++;
+            j++;
+        }
+        else if (a[i] < b[j]) {
+            i++;
+        }
+        else {
+            j++;
+        }
+    }
+    return result;
+}
+// Positions of services that may contain the query, or null if the query is too short to narrow down
+function findCandidates(index, queryLower) {
+    if (queryLower.length < TRIGRAM_LENGTH) {
+        return null;
+    }
+    const postingLists = [];
+    const seen = new Set();
+    for (let i = 0; i + TRIGRAM_LENGTH <= queryLower.length; i++) {
+        const trigram = queryLower.substring(i, i + TRIGRAM_LENGTH);
+        if (seen.has(trigram)) {
+            continue;
+        }
+        seen.add(trigram);
+        const postings = index.trigrams.get(trigram);
+        if (postings === undefined) {
+            return [];
+        }
+        postingLists.push(postings);
+    }
+    // Start from the rarest trigram so the running intersection stays small
+    postingLists.sort((a, b) => a.length - b.length);
+    let candidates = postingLists[0];
+    for (let i = 1; i < postingLists.length && candidates.length > 0; i++) {
+        candidates = intersectSorted(candidates, postingLists[i]);
+    }
+    return candidates;
+}
+function searchServices(index, query) {
     const queryLower = query.toLowerCase();
     const results = [];
-    for (const service of data.data) {
-        const name = (service.name || "").toLowerCase();
-        const description = (service.description || "").toLowerCase();
-        if (name.includes(queryLower) || description.includes(queryLower)) {
-            const desc = service.description || "";
-            results.push({
-                id: service.id,
-                name: service.name,
-                description: desc.length > 200 ? desc.substring(0, 200) + "..." : desc,
-                url: service.meta?.url || "",
-                fees: service.fees || "",
-            });
+    const candidates = findCandidates(index, queryLower) ?? index.summaries.keys();
+    for (const position of candidates) {
+        if (index.namesLower[position].includes(queryLower) ||
+            index.descriptionsLower[position].includes(queryLower)) {
+            results.push(index.summaries[position]);
         }
     }
     return results;
 }
-function getServiceById(data, serviceId) {
-    return data.data.find((service) => service.id === serviceId) || null;
+function getServiceById(index, serviceId) {
+    return index.byId.get(serviceId) || null;
 }
 function formatServiceDetails(service) {
     const lines = [
@@ -123,6 +361,33 @@ function formatServiceDetails(service) {
     }
     return lines.join("\n");
 }
+function getServiceDetails(index, serviceId) {
+    let rendered = detailsCache.get(index);
+    if (rendered === undefined) {
+        rendered = new Map();
+        detailsCache.set(index, rendered);
+    }
+    const cached = rendered.get(serviceId);
+    if (cached !== undefined) {
+        // Re-insert to mark as most recently used
+        rendered.delete(serviceId);
+        rendered.set(serviceId, cached);
+        return cached;
+    }
+    const service = getServiceById(index, serviceId);
+    if (!service) {
+        return null;
+    }
+    const details = formatServiceDetails(service);
+    rendered.set(serviceId, details);
+    if (rendered.size > DETAILS_CACHE_SIZE) {
+        const oldest = rendered.keys().next();
+        if (!oldest.done) {
+            rendered.delete(oldest.value);
+        }
+    }
+    return details;
+}
 function listAllServices(data, limit = 50) {
     return data.data.slice(0, limit).map((service) => ({
         id: service.id,
@@ -194,102 +459,57 @@ server.setRequestHandler(ListToolsRequestSchema, async () => {
         ],
     };
 });
-server.setRequestHandler(CallToolRequestSchema, async (request) => {
-    try {
-        const data = await fetchServicesData();
-        switch (request.params.name) {
-            case "search_services": {
-                const query = String(request.params.arguments?.query || "");
-                if (!query) {
-                    return {
-                        content: [
-                            {
-                                type: "text",
-                                text: "Error: query parameter is required",
-                            },
-                        ],
-                    };
-                }
-                const results = searchServices(data, query);
-                if (results.length === 0) {
-                    return {
-                        content: [
-                            {
-                                type: "text",
-                                text: `No services found matching '${query}'`,
-                            },
-                        ],
-                    };
-                }
-                let output = `Found ${results.length} service(s) matching '${query}':\n\n`;
-                for (const result of results) {
-                    output += `**${result.name}**\n`;
-                    output += `ID: ${result.id}\n`;
-                    output += `URL: ${result.url}\n`;
-                    output += `Fees: ${result.fees}\n`;
-                    output += `Description: ${result.description}\n\n`;
-                }
-                return {
-                    content: [
-                        {
-                            type: "text",
-                            text: output,
-                        },
-                    ],
-                };
-            }
-            case "get_service_details": {
-                const serviceId = String(request.params.arguments?.service_id || "");
-                if (!serviceId) {
-                    return {
-                        content: [
-                            {
-                                type: "text",
-                                text: "Error: service_id parameter is required",
-                            },
-                        ],
-                    };
-                }
-                const service = getServiceById(data, serviceId);
-                if (!service) {
-                    return {
-                        content: [
-                            {
-                                type: "text",
-                                text: `Service with ID '${serviceId}' not found`,
-                            },
-                        ],
-                    };
-                }
-                const details = formatServiceDetails(service);
-                return {
-                    content: [
-                        {
-                            type: "text",
-                            text: details,
-                        },
-                    ],
-                };
-            }
-            case "list_services": {
-                const limit = Math.min(Number(request.params.arguments?.limit || 50), 200);
-                const services = listAllServices(data, limit);
-                let output = `Berlin Administrative Services (showing ${services.length} of ${data.datacount} total):\n\n`;
-                for (const service of services) {
-                    output += `- **${service.name}** (ID: ${service.id})\n`;
-                    output += `  ${service.url}\n`;
-                }
-                return {
-                    content: [
-                        {
-                            type: "text",
-                            text: output,
-                        },
-                    ],
-                };
-            }
-            case "get_services_stats": {
-                const stats = `# Berlin Services Statistics
+function textResult(text) {
+    return {
+        content: [
+            {
+                type: "text",
+                text,
+            },
+        ],
+    };
+}
+function handleSearchServices(index, args) {
+    const query = String(args?.query || "");
+    if (!query) {
+        return textResult("Error: query parameter is required");
+    }
+    const results = searchServices(index, query);
+    if (results.length === 0) {
+        return textResult(`No services found matching '${query}'`);
+    }
+    const parts = [`Found ${results.length} service(s) matching '${query}':\n\n`];
+    for (const result of results) {
+        parts.push(`**${result.name}**\n`, `ID: ${result.id}\n`, `URL: ${result.url}\n`, `Fees: ${result.fees}\n`, `Description: ${result.description}\n\n`);
+    }
+    return textResult(parts.join(""));
+}
+function handleGetServiceDetails(index, args) {
+    const serviceId = String(args?.service_id || "");
+    if (!serviceId) {
+        return textResult("Error: service_id parameter is required");
+    }
+    const details = getServiceDetails(index, serviceId);
+    if (details === null) {
+        return textResult(`Service with ID '${serviceId}' not found`);
+    }
+    return textResult(details);
+}
+function handleListServices(index, args) {
+    const { data } = index;
+    const limit = Math.min(Number(args?.limit || 50), 200);
+    const services = listAllServices(data, limit);
+    const parts = [
+        `Berlin Administrative Services (showing ${services.length} of ${data.datacount} total):\n\n`,
+    ];
+    for (const service of services) {
+        parts.push(`- **${service.name}** (ID: ${service.id})\n`, `  ${service.url}\n`);
+    }
+    return textResult(parts.join(""));
+}
+function handleGetServicesStats(index) {
+    const { data } = index;
+    return textResult(`# Berlin Services Statistics
 
 **Total Services:** ${data.datacount}
 **Last Updated:** ${data.created}
@@ -298,39 +518,33 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
 **Error Status:** ${data.error}
 
 The dataset contains information about ${data.datacount} administrative services provided by Berlin authorities.
-`;
-                return {
-                    content: [
-                        {
-                            type: "text",
-                            text: stats,
-                        },
-                    ],
-                };
-            }
-            default:
-                return {
-                    content: [
-                        {
-                            type: "text",
-                            text: `Unknown tool: ${request.params.name}`,
-                        },
-                    ],
-                };
-        }
+`);
+}
+const toolHandlers = new Map([
+    ["search_services", handleSearchServices],
+    ["get_service_details", handleGetServiceDetails],
+    ["list_services", handleListServices],
+    ["get_services_stats", handleGetServicesStats],
+]);
+server.setRequestHandler(CallToolRequestSchema, async (request) => {
+    const handler = toolHandlers.get(request.params.name);
+    if (handler === undefined) {
+        return textResult(`Unknown tool: ${request.params.name}`);
+    }
+    try {
+        const index = await fetchServicesData();
+        return handler(index, request.params.arguments);
     }
     catch (error) {
-        return {
-            content: [
-                {
-                    type: "text",
-                    text: `Error: ${error instanceof Error ? error.message : String(error)}`,
-                },
-            ],
-        };
+        return textResult(`Error: ${error instanceof Error ? error.message : String(error)}`);
     }
 });
 async function main() {
+    // Force a fresh download, e.g. `kill -HUP <pid>` after an upstream change within the TTL
+    process.on("SIGHUP", () => {
+        invalidateCache();
+        console.error("Services cache invalidated, the next request fetches a fresh copy");
+    });
     const transport = new StdioServerTransport();
     await server.connect(transport);
     console.error("Berlin Services MCP Server running on stdio");